@@ -15,17 +15,41 @@
 支持多项任务可能会产生一定的延时，但应该在可控范围以内。
 """
 
-import collections
 import json
 import logging
 import os
 import sched
+import selectors
 import socket
+import struct
 import time
 
 from . import util
 
 
+# 报文使用紧凑格式的JSON，预先构造编码器，避免每次json.dumps检查参数；
+# 非ASCII字符直接以UTF-8编码，比\uXXXX转义更短，UDP报文更不容易超长
+_json_encode = json.JSONEncoder(separators=(',', ':'),
+                                ensure_ascii=False).encode
+_json_encode_ascii = json.JSONEncoder(separators=(',', ':')).encode
+
+# 报文头为2字节大端序的报文长度
+_HDR = struct.Struct('>H')
+
+# 向Server端建链、发送数据的默认超时时间（秒）
+_SND_TIMEOUT = 3
+
+
+def json_dumps(obj):
+    """将obj编码为UTF-8的JSON报文。"""
+    try:
+        return _json_encode(obj).encode()
+    except UnicodeEncodeError:
+        # 含有无法以UTF-8编码的字符（如文件名解码失败产生的代理对）时，
+        # 退回转义方式
+        return _json_encode_ascii(obj).encode()
+
+
 class SimpleDelayTrigger:
     """简单的延时触发器，集成到Agent类中作为定时器使用。
 
@@ -42,34 +66,47 @@ class SimpleDelayTrigger:
 class AcceptDelayTrigger:
     """计时器类，集成到Agent类中作为定时器使用。
 
-    wait方法利用accept作为定时器，同时完成定时以及接收服务器以TCP短链接方式发
-    来指令的功能。
+    wait方法利用select作为定时器，同时完成定时以及接收服务器以TCP短链接方式发
+    来指令的功能。监听socket只在创建时注册一次，每次wait不必再设置超时。
     """
+    # 接收指令的超时时间（秒），避免连接后不发数据的客户端阻塞调度器
+    cmd_timeout = 3
+
     def __init__(self, host):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind(host)
         self.sock.listen(1)
+        # select报告可读后连接仍可能已被对端放弃，accept不能阻塞
+        self.sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
         self.logger = logging.getLogger(__name__)
+        # 每次wait都可能输出调试日志，预先判断是否需要输出
+        self._dbg = self.logger.isEnabledFor(logging.DEBUG)
 
     def wait(self, timeout):
         """wait方法的退出条件有两种：
 
-        - accept超时，返回值为(None, None)；
+        - 等待超时，返回值为(None, None)；
         - 收到新连接并接收到服务器的指令，返回值为(cmd, detail)；
         """
         # sched模块每个循环会执行一次delayfunc(0)以让出CPU
-        if timeout > 0:
-            self.logger.debug('set accept timeout to %ss', timeout)
-        self.sock.settimeout(timeout)
+        if self._dbg and timeout > 0:
+            self.logger.debug('wait cmd for %ss', timeout)
+        if not self.selector.select(timeout):
+            return (None, None)
         try:
             self.conn, _ = self.sock.accept()
+            self.conn.settimeout(self.cmd_timeout)
             # 服务器发来的指令不应该太长
-            buf = conn.recv(1024)
-            self.logger.debug('recv cmd from server: %s', buf)
+            buf = self.conn.recv(1024)
+            if self._dbg:
+                self.logger.debug('recv cmd from server: %s', buf)
             pack = json.loads(buf.decode())
         except socket.error as err:
-            self.logger.debug('recv cmd error: %s', err)
+            if self._dbg:
+                self.logger.debug('recv cmd error: %s', err)
             # 将socket超时与其它socket错误都处理为直接返回无指令。
             if hasattr(self, 'conn'):
                 self.conn.close()
@@ -97,11 +134,17 @@ class BaseAgent(object):
     可以被覆盖的方法：
 
     - load_conf(fname)
-    - task_wrapper()
+    - check_conf()
+    - resolve_ip()
+    - pack_template(mon_type)
+    - task_wrapper(task)
     - connection_init()
     - connection_close()
     - send_infor(pack)
 
+    注意：task['execProg']保持为配置中的函数名，不再被替换为监控函数；覆盖
+    task_wrapper时应调用all_task_reg解析好的task['_action']。
+
     可以被覆盖的属性：
 
     - scher
@@ -114,30 +157,75 @@ class BaseAgent(object):
         - ext: 包含task代码的外部模块/包；
         - config_file: 包含task相关配置的文件，默认为./etc/agent.conf；
         - delayfunc: 调度器空闲时执行的函数，默认为time.sleep，可替换；
-        - scher: 调度器，默认为sched.scheduler，可替换；
+        - scher: 调度器，默认为以time.monotonic计时的sched.scheduler，可替换；
+        - ip: 本机IP地址，只在启动时解析一次；
         """
+        self.logger = logging.getLogger(__name__)
+        # 每次发送都可能输出调试日志，预先判断是否需要输出，日志级别应在创建
+        # Agent前设置好
+        self._dbg = self.logger.isEnabledFor(logging.DEBUG)
         self.fname = config_file
         self.load_conf(self.fname)
+        self.check_conf()
         self.ext = ext_module
+        self.ip = self.resolve_ip()
+        # 按monType索引task，供接收到服务器指令时直接查找；monType重复时
+        # 与配置文件中靠前的task对应
+        self.tasks = {}
+        for t in self.conf['monItems']:
+            self.tasks.setdefault(t['monType'], t)
+        # 报文中type、nodId、ip对同一task是固定的，预先编码为报文前缀
+        self.pack_tmpls = {t['monType']: self.pack_template(t['monType'])
+                           for t in self.conf['monItems']}
         self.connection_init()
+        # 打包、发送方法在此绑定一次，task_wrapper不必每次经MRO查找
+        self._pack = self.pack_infor
+        self._send = self.send_infor
         self.timer = timer
-        self.scher = sched.scheduler(time.time, self.delayfunc)
-        self.logger = logging.getLogger(__name__)
+        self.scher = sched.scheduler(time.monotonic, self.delayfunc)
+
+    def resolve_ip(self):
+        """解析本机IP地址，解析失败时使用回环地址。"""
+        try:
+            return socket.gethostbyname(socket.gethostname())
+        except socket.error as err:
+            self.logger.error('resolve ip error: %s', err)
+            return '127.0.0.1'
 
     def load_conf(self, fname):
-        """读取配置文件，配置信息为OrderDict对象。"""
+        """读取配置文件，配置信息为dict对象。"""
         with open(os.path.expandvars(fname)) as f:
-            # 使用OrderedDict存取，是为了方便配置文件的管理、核对
-            self.conf = json.load(f, object_pairs_hook=collections.OrderedDict)
+            # dict保持配置项在文件中的顺序，方便配置文件的管理、核对
+            self.conf = json.load(f)
+
+    def check_conf(self):
+        """检查各task的必要配置项，以免到调度时才因配置错误退出。"""
+        for task in self.conf['monItems']:
+            # 与one_task_reg一致，interval以外的触发方式都按定时任务处理
+            if task.get('monTrigger') == 'interval':
+                trig_key = 'trigInter'
+            else:
+                trig_key = 'trigTime'
+            for key in ('monTrigger', 'monType', 'execProg', 'execArgs',
+                        'execPrio', trig_key):
+                if key not in task:
+                    raise AssertionError('{} missing in task {}'.format(
+                        key, task.get('monType')))
 
     def one_task_reg(self, task):
         if task['monTrigger'] == 'interval':
-            self.scher.enter(task['trigInter'], task['execPrio'],
-                             self.one_task_reg, (task,))
-        else:
-            nexttime = util.attime(task['trigTime'])
+            # 按上次的计划时刻推算下次时刻，调度延迟不会逐次累积；
+            # 落后于计划时只立即执行一次，不补执行错过的各次
+            now = self.scher.timefunc()
+            nexttime = max(task.get('_next', now) + task['trigInter'], now)
+            task['_next'] = nexttime
             self.scher.enterabs(nexttime, task['execPrio'],
                                 self.one_task_reg, (task,))
+        else:
+            # 调度器以单调时钟计时，定时任务需换算为相对当前时刻的延时
+            delay = util.attime(task['trigTime']) - time.time()
+            self.scher.enter(delay, task['execPrio'],
+                             self.one_task_reg, (task,))
         return self.task_wrapper(task)
 
     def all_task_reg(self):
@@ -147,6 +235,9 @@ class BaseAgent(object):
         # 捕捉到异常后的处理机制需要与监控Server端约定
         def task_catch_except(one_task):
             action = getattr(self.ext, one_task['execProg'])
+            if getattr(action, '_agent_njit', False):
+                action = util.njit(action)
+            logger = self.logger
 
             def func(*args):
                 try:
@@ -154,30 +245,43 @@ class BaseAgent(object):
                 except KeyboardInterrupt:
                     raise
                 except Exception as err:
-                    self.logger.error(err)
+                    logger.error(err)
                     return {'error': str(err)}
             return func
 
+        # 监控函数只解析一次，保存到task['_action']；配置中的execProg保持原
+        # 样，可以重复注册
+        for task in self.conf['monItems']:
+            task['_action'] = task_catch_except(task)
         for task in self.conf['monItems']:
-            task['execProg'] = task_catch_except(task)
             self.one_task_reg(task)
 
+    def pack_template(self, mon_type):
+        """将报文中不随时间变化的公共数据编码为报文前缀。
+
+        返回值形如b'{"type":...,"ip":...,"nodId":...,"detail":'。
+        """
+        dic = {'type': mon_type, 'ip': self.ip, 'nodId': self.conf['nodId']}
+        return json_dumps(dic)[:-1] + b',"detail":'
+
     def pack_infor(self, *infor):
         """为task返回的数据补充公共报文数据。"""
-        dic = {}
-        dic['type'], dic['detail'] = infor
-        dic['count'] = len(dic['detail'])
-        dic['ip'] = socket.gethostbyname(socket.gethostname())
-        dic['nodId'] = self.conf['nodId']
-        dic['timeStamp'] = util.timestamp()
-        pack = json.dumps(dic).encode()
-        header = len(pack).to_bytes(2, 'big')
-        return header + pack
+        mon_type, detail = infor
+        prefix = self.pack_tmpls.get(mon_type)
+        if prefix is None:
+            prefix = self.pack_template(mon_type)
+        body = json_dumps(detail)
+        # 时间戳只包含数字，无需经过JSON编码
+        tail = b',"count":%d,"timeStamp":"%s"}' % (
+            len(detail), util.timestamp().encode())
+        # 各段一次性拼接，避免中间结果的重复分配与复制
+        header = _HDR.pack(len(prefix) + len(body) + len(tail))
+        return b''.join((header, prefix, body, tail))
 
     def task_wrapper(self, task):
         """组合task执行及将数据发出的所有动作。"""
-        self.send_infor(self.pack_infor(task['monType'],
-                                        task['execProg'](task['execArgs'])))
+        self._send(self._pack(task['monType'],
+                              task['_action'](task['execArgs'])))
 
     def delayfunc(self, timeout):
         try:
@@ -195,14 +299,12 @@ class BaseAgent(object):
             if ret_val == 'update':
                 pass
             else:
-                mon_types = [i['monType'] for i in self.conf['monItems']]
-                if ret_val in mon_types:
-                    task = self.conf['monItems'][mon_types.index(ret_val)]
-                    self.scher.enterabs(time.time(), task['execPrio'],
-                                        self.task_wrapper, (task,))
-                    self.timer.response(is_ok=True)
-                else:
+                task = self.tasks.get(ret_val)
+                if task is None:
                     raise AssertionError('invalid cmd')
+                self.scher.enterabs(self.scher.timefunc(), task['execPrio'],
+                                    self.task_wrapper, (task,))
+                self.timer.response(is_ok=True)
         except (AssertionError, OSError) as err:
             self.timer.response(is_ok=False, detail=str(err))
 
@@ -237,17 +339,43 @@ class BaseAgent(object):
         pass
 
 
+def tcp_socket(timeout=_SND_TIMEOUT, sndbuf=None):
+    """创建向Server端发送数据的TCP socket。
+
+    关闭Nagle算法，避免小报文被延迟发送；sndbuf（srvInfo中的sndBufSize）不为
+    None时同时调整发送缓冲区大小。
+    所有task在同一线程中调度，建链、发送阻塞期间其他task都要等待，因此超时时
+    间timeout（秒）可通过srvInfo中的sndTimeout缩短，默认为3秒。
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if sndbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    return sock
+
+
 class ShortTCPMixIn(object):
-    """处理TCP短连接通信的MixIn类。"""
+    """处理TCP短连接通信的MixIn类。
+
+    Server端按每个连接一个报文处理，因此每个报文都要新建连接；需要复用连接时
+    应使用LongTCPMixIn。
+    """
+    def connection_init(self):
+        """预先取出Server端地址及socket参数，避免每次发送时查找配置。"""
+        srvinfo = self.conf['srvInfo']
+        self.srvinfo = (srvinfo['srvAddr'], srvinfo['srvPort'])
+        self.sockopts = (srvinfo.get('sndTimeout', _SND_TIMEOUT),
+                         srvinfo.get('sndBufSize'))
+
     def send_infor(self, pack):
         """发送数据到Server端。"""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(3)
-        srvinfo = self.conf['srvInfo']
+        sock = tcp_socket(*self.sockopts)
         try:
-            sock.connect((srvinfo['srvAddr'], srvinfo['srvPort']))
-            sock.send(pack)
-            self.logger.debug('send pack success: %s', pack)
+            sock.connect(self.srvinfo)
+            sock.sendall(pack)
+            if self._dbg:
+                self.logger.debug('send pack success: %s', pack)
         except socket.error as err:
             self.logger.error(err)
         finally:
@@ -261,9 +389,10 @@ class LongTCPMixIn(object):
 
         每次调用只尝试一次，以免日志量突增。
         """
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.settimeout(3)
         srvinfo = self.conf['srvInfo']
+        self.sock = tcp_socket(srvinfo.get('sndTimeout', _SND_TIMEOUT),
+                               srvinfo.get('sndBufSize'))
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         try:
             self.sock.connect((srvinfo['srvAddr'], srvinfo['srvPort']))
         except socket.error as err:
@@ -278,8 +407,9 @@ class LongTCPMixIn(object):
         发送失败时会且仅会尝试一次重新建链。
         """
         try:
-            self.sock.send(pack)
-            self.logger.debug('send pack success: %s', pack)
+            self.sock.sendall(pack)
+            if self._dbg:
+                self.logger.debug('send pack success: %s', pack)
         except socket.error as err:
             self.logger.error(err)
             self.connection_close()
@@ -292,10 +422,18 @@ class UDPMixIn(object):
     由于数据包被分片会增大报文丢失的可能，UDP方式不允许传送长度超过1400的报文。
     """
     def connection_init(self):
-        """创建UDP socket。"""
+        """创建UDP socket并绑定Server端地址。
+
+        connect后内核不必在每次发送时解析地址、查找路由，Server端不可达时也能
+        在下一次发送时得到错误。
+        """
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.srvinfo = (self.conf['srvInfo']['srvAddr'],
                         self.conf['srvInfo']['srvPort'])
+        try:
+            self.sock.connect(self.srvinfo)
+        except socket.error as err:
+            self.logger.error(err)
 
     def connection_close(self):
         self.sock.close()
@@ -304,8 +442,9 @@ class UDPMixIn(object):
         """发送数据到Server端。"""
         try:
             assert len(pack) < 1400, 'UDP pack should not longer than MTU.'
-            self.sock.sendto(pack, self.srvinfo)
-            self.logger.debug('send pack success: %s', pack)
+            self.sock.send(pack)
+            if self._dbg:
+                self.logger.debug('send pack success: %s', pack)
         except socket.error as err:
             self.logger.error(err)
             self.connection_close()
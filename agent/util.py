@@ -7,6 +7,7 @@
 #
 
 import datetime
+import inspect
 
 
 def attime(timetuple):
@@ -21,3 +22,37 @@ def attime(timetuple):
 
 def timestamp():
     return datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+
+
+def jit(func):
+    """标记task函数为数值计算型，注册时将尝试用numba编译。
+
+    只对普通函数有效（ext为模块时），未安装numba或编译失败时函数按原样执行。
+    """
+    func._agent_njit = True
+    return func
+
+
+def njit(func):
+    """用numba编译函数。
+
+    方法等非普通函数以及未安装numba时原样返回；numba在首次调用时才编译，编译
+    失败后改为直接调用原函数。
+    """
+    if not inspect.isfunction(func):
+        return func
+    try:
+        import numba
+    except ImportError:
+        return func
+    compile_error = numba.core.errors.NumbaError
+    compiled = numba.njit(cache=True)(func)
+
+    def wrapper(*args):
+        nonlocal compiled
+        try:
+            return compiled(*args)
+        except compile_error:
+            compiled = func
+            return func(*args)
+    return wrapper
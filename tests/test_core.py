@@ -11,13 +11,15 @@ import logging
 import os
 import shutil
 import socket
+import sys
 import tempfile
 import threading
 import time
+import types
 import unittest
 import unittest.mock
 
-from agent import core
+from agent import core, util
 
 
 TEST_PACK = b'\x00\x1e{"type": "test", "length": 10}'
@@ -62,6 +64,11 @@ class ExtTestMock:
         # 只能以KeyboardInterrupt中止run_forever
         raise KeyboardInterrupt
 
+    @staticmethod
+    @util.jit
+    def numeric(args):
+        return args
+
     def raise_exception(self, args):
         raise Exception
 
@@ -69,6 +76,60 @@ class ExtTestMock:
         raise KeyboardInterrupt
 
 
+class TestJsonDumps(unittest.TestCase):
+    def test_non_ascii_not_escaped(self):
+        self.assertEqual(core.json_dumps(['监控']), '["监控"]'.encode())
+
+    def test_surrogate_escaped(self):
+        buf = core.json_dumps(['\udcff'])
+        self.assertEqual(buf, b'["\\udcff"]')
+        self.assertEqual(json.loads(buf.decode()), ['\udcff'])
+
+
+class FakeNumbaError(Exception):
+    pass
+
+
+def fake_numba(njit):
+    errors = types.SimpleNamespace(NumbaError=FakeNumbaError)
+    return types.SimpleNamespace(njit=lambda **kwargs: njit,
+                                 core=types.SimpleNamespace(errors=errors))
+
+
+def numeric_task(args):
+    return args
+
+
+class TestNjit(unittest.TestCase):
+    def test_njit_without_numba(self):
+        with unittest.mock.patch.dict(sys.modules, {'numba': None}):
+            self.assertIs(util.njit(numeric_task), numeric_task)
+
+    def test_njit_skip_method(self):
+        method = NullLog().error
+        compile_func = unittest.mock.Mock()
+        numba = fake_numba(compile_func)
+        with unittest.mock.patch.dict(sys.modules, {'numba': numba}):
+            self.assertIs(util.njit(method), method)
+        compile_func.assert_not_called()
+
+    def test_njit_compiled(self):
+        compiled = unittest.mock.Mock(return_value='compiled')
+        numba = fake_numba(lambda func: compiled)
+        with unittest.mock.patch.dict(sys.modules, {'numba': numba}):
+            func = util.njit(numeric_task)
+        self.assertEqual(func(1), 'compiled')
+
+    def test_njit_fallback_when_compile_failed(self):
+        compiled = unittest.mock.Mock(side_effect=FakeNumbaError)
+        numba = fake_numba(lambda func: compiled)
+        with unittest.mock.patch.dict(sys.modules, {'numba': numba}):
+            func = util.njit(numeric_task)
+        self.assertEqual(func(1), 1)
+        self.assertEqual(func(2), 2)
+        self.assertEqual(compiled.call_count, 1)
+
+
 class TestBaseAgent(unittest.TestCase):
     def setUp(self):
         fd, self.fname = tempfile.mkstemp(text=True)
@@ -102,6 +163,28 @@ class TestBaseAgent(unittest.TestCase):
         with self.assertRaises(FileNotFoundError):
             self.make_agent(core.BaseAgent, None)
 
+    def write_conf(self, conf):
+        with open(self.fname, 'w') as fp:
+            json.dump(conf, fp)
+
+    def test_check_conf_time_trigger_without_trig_time(self):
+        self.init_conf['monItems'][0]['monTrigger'] = 'timing'
+        self.write_conf(self.init_conf)
+        with self.assertRaises(AssertionError):
+            self.make_agent(core.BaseAgent, None)
+
+    def test_check_conf_time_trigger_with_trig_time(self):
+        self.init_conf['monItems'][0]['monTrigger'] = 'timing'
+        self.init_conf['monItems'][0]['trigTime'] = [1, 0, 0]
+        self.write_conf(self.init_conf)
+        self.make_agent(core.BaseAgent, None)
+
+    def test_check_conf_missing_key(self):
+        del self.init_conf['monItems'][0]['trigInter']
+        self.write_conf(self.init_conf)
+        with self.assertRaises(AssertionError):
+            self.make_agent(core.BaseAgent, None)
+
     def test_delayfunc_wait_time(self):
         inst = self.make_agent(core.BaseAgent, None)
         start = time.time()
@@ -148,6 +231,29 @@ class TestBaseAgent(unittest.TestCase):
         self.assertEqual(ret_dict['count'], len(infor[1]))
         self.assertEqual(ret_dict['nodId'], self.init_conf['nodId'])
 
+    def test_pack_infor_fields(self):
+        inst = self.make_agent(core.BaseAgent, None)
+        packet = inst.pack_infor('0011', [['a', 1], {'b': None}])
+        ret_dict = json.loads(packet[2:].decode())
+        self.assertEqual(ret_dict.keys(), {'type', 'ip', 'nodId', 'detail',
+                                           'count', 'timeStamp'})
+        self.assertEqual(ret_dict['type'], '0011')
+        self.assertEqual(ret_dict['ip'], inst.ip)
+        self.assertEqual(ret_dict['detail'], [['a', 1], {'b': None}])
+        self.assertEqual(len(ret_dict['timeStamp']), 14)
+
+    def test_pack_infor_unknown_type(self):
+        inst = self.make_agent(core.BaseAgent, None)
+        ret_dict = json.loads(inst.pack_infor('9999', [])[2:].decode())
+        self.assertEqual(ret_dict['type'], '9999')
+        self.assertEqual(ret_dict['ip'], inst.ip)
+
+    def test_resolve_ip_fallback_when_socket_error(self):
+        inst = self.make_agent(core.BaseAgent, None)
+        with unittest.mock.patch('socket.gethostbyname',
+                                 side_effect=socket.gaierror):
+            self.assertEqual(inst.resolve_ip(), '127.0.0.1')
+
     def test_all_task_reg_keyboard_interrupt_should_raise_out(self):
         ext = ExtTestMock(self.init_conf['monItems'][0], None)
         inst = self.make_agent(core.BaseAgent, ext)
@@ -161,6 +267,62 @@ class TestBaseAgent(unittest.TestCase):
         inst.conf['monItems'][0]['execProg'] = 'raise_exception'
         inst.all_task_reg()
 
+    def test_all_task_reg_keep_exec_prog(self):
+        ext = ExtTestMock(self.init_conf['monItems'][0], None)
+        inst = self.make_agent(core.BaseAgent, ext)
+        inst.conf['monItems'][0]['execProg'] = 'raise_exception'
+        inst.all_task_reg()
+        self.assertEqual(inst.conf['monItems'][0]['execProg'],
+                         'raise_exception')
+        inst.all_task_reg()
+
+    def test_all_task_reg_same_mon_type_run_own_prog(self):
+        ext = ExtTestMock(self.init_conf['monItems'][0], None)
+        inst = self.make_agent(core.BaseAgent, ext)
+        task = inst.conf['monItems'][0]
+        task['execProg'] = 'numeric'
+        other = dict(task, execProg='raise_exception')
+        inst.conf['monItems'].append(other)
+        inst._send = unittest.mock.Mock()
+        inst.all_task_reg()
+        details = [json.loads(call.args[0][2:].decode())['detail']
+                   for call in inst._send.call_args_list]
+        self.assertEqual(details, [task['execArgs'], {'error': ''}])
+
+    def test_received_cmd_same_mon_type_run_first_task(self):
+        self.init_conf['monItems'].append(
+            dict(self.init_conf['monItems'][0], execProg='other'))
+        self.write_conf(self.init_conf)
+        inst = self.make_agent(core.BaseAgent, None)
+        with unittest.mock.patch.object(inst.timer, 'wait',
+                                        return_value=('0011', None)):
+            inst.timer.response = unittest.mock.Mock()
+            inst.delayfunc(5)
+            task = inst.scher.queue[-1].argument[0]
+            self.assertIs(task, inst.conf['monItems'][0])
+            self.assertEqual(task['execProg'], 'onecheck')
+
+    def test_all_task_reg_jit_task(self):
+        ext = ExtTestMock(self.init_conf['monItems'][0], None)
+        inst = self.make_agent(core.BaseAgent, ext)
+        inst.conf['monItems'][0]['execProg'] = 'numeric'
+        with unittest.mock.patch.object(util, 'njit',
+                                        side_effect=lambda f: f) as mock:
+            inst.all_task_reg()
+            mock.assert_called_with(ext.numeric)
+
+    def test_one_task_reg_interval_not_drift(self):
+        inst = self.make_agent(core.BaseAgent, None)
+        inst.task_wrapper = unittest.mock.Mock()
+        task = inst.conf['monItems'][0]
+        task['trigInter'] = interval = 10
+        inst.one_task_reg(task)
+        first = inst.scher.queue[0].time
+        time.sleep(0.05)
+        inst.scher.cancel(inst.scher.queue[0])
+        inst.one_task_reg(task)
+        self.assertEqual(inst.scher.queue[0].time, first + interval)
+
     def test_run_forever_with_interval_task(self):
         reg_hist = []
         test_ext = ExtTestMock(self.init_conf['monItems'][0], reg_hist)
@@ -177,13 +339,46 @@ class TestBaseAgent(unittest.TestCase):
         self.assertLess(abs(times[1] - times[0] - interval), 0.001)
 
 
+class TestTCPSocket(unittest.TestCase):
+    def test_tcp_nodelay(self):
+        sock = core.tcp_socket()
+        try:
+            self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP,
+                                            socket.TCP_NODELAY))
+        finally:
+            sock.close()
+
+    def test_timeout_default_and_from_config(self):
+        default = core.tcp_socket()
+        sock = core.tcp_socket(0.5)
+        try:
+            self.assertEqual(default.gettimeout(), 3)
+            self.assertEqual(sock.gettimeout(), 0.5)
+        finally:
+            sock.close()
+            default.close()
+
+    def test_sndbuf_size_from_config(self):
+        default = core.tcp_socket()
+        sock = core.tcp_socket(sndbuf=1 << 17)
+        try:
+            self.assertNotEqual(
+                sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+                default.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
+        finally:
+            sock.close()
+            default.close()
+
+
 class TestShortTCPMixIn(unittest.TestCase):
     def setUp(self):
         self.mix_in = core.ShortTCPMixIn()
         self.mix_in.conf = {}
         self.mix_in.conf['srvInfo'] = {'srvAddr': '127.0.0.1', 'srvPort': 8001}
         self.mix_in.logger = NullLog()
+        self.mix_in._dbg = False
         self.server_address = ('127.0.0.1', 8001)
+        self.mix_in.connection_init()
         self.recv_count = 0
 
     def make_server(self, server, test_pack):
@@ -215,6 +410,11 @@ class TestShortTCPMixIn(unittest.TestCase):
     def tearDown(self):
         pass
 
+    def test_connection_init_read_sockopts(self):
+        self.mix_in.conf['srvInfo']['sndTimeout'] = 0.5
+        self.mix_in.connection_init()
+        self.assertEqual(self.mix_in.sockopts, (0.5, None))
+
     def test_send_infor_send_only_once_when_server_invalid(self):
         self.mix_in.send_infor(TEST_PACK)
         self.assertEqual(self.mix_in.logger.called, 1)
@@ -234,6 +434,7 @@ class TestLongTCPMixIn(unittest.TestCase):
         self.mix_in.conf = {}
         self.mix_in.conf['srvInfo'] = {'srvAddr': '127.0.0.1', 'srvPort': 8001}
         self.mix_in.logger = NullLog()
+        self.mix_in._dbg = False
         self.server_address = ('127.0.0.1', 8001)
         self.mix_in.connection_init()
         self.mix_in.connection_close()
@@ -292,6 +493,7 @@ class TestUDPMixIn(unittest.TestCase):
         self.mix_in.conf = {}
         self.mix_in.conf['srvInfo'] = {'srvAddr': '127.0.0.1', 'srvPort': 8001}
         self.mix_in.logger = NullLog()
+        self.mix_in._dbg = False
         self.server_address = ('127.0.0.1', 8001)
         self.mix_in.connection_init()
         self.recv_count = 0
@@ -341,6 +543,19 @@ class TestAcceptDelayTrigger(unittest.TestCase):
         self.inst = core.AcceptDelayTrigger(('127.0.0.1', 0))
         self.inst.sock.close()
         self.inst.sock = unittest.mock.Mock()
+        self.inst.selector.close()
+        self.inst.selector = unittest.mock.Mock()
+        self.inst.selector.select = unittest.mock.Mock(return_value=[None])
+
+    def test_wait_can_be_patched_on_instance(self):
+        with unittest.mock.patch.object(self.inst, 'wait',
+                                        return_value=('0011', None)):
+            self.assertEqual(self.inst.wait(10), ('0011', None))
+
+    def test_wait_return_no_cmd_when_no_event(self):
+        self.inst.selector.select = unittest.mock.Mock(return_value=[])
+        self.assertEqual(self.inst.wait(10), (None, None))
+        self.inst.sock.accept.assert_not_called()
 
     def test_wait_return_no_cmd_when_socket_timeout(self):
         self.inst.sock.accept = unittest.mock.Mock(side_effect=socket.timeout)
@@ -350,6 +565,12 @@ class TestAcceptDelayTrigger(unittest.TestCase):
         self.inst.sock.accept = unittest.mock.Mock(side_effect=socket.error)
         self.assertEqual(self.inst.wait(10), (None, None))
 
+    def test_wait_return_cmd_when_received(self):
+        conn = unittest.mock.Mock()
+        conn.recv = unittest.mock.Mock(return_value=b'{"cmd": "0011"}')
+        self.inst.sock.accept = unittest.mock.Mock(return_value=(conn, None))
+        self.assertEqual(self.inst.wait(10), ('0011', None))
+
     def test_wait_should_raise_exception_when_other_error(self):
         self.inst.sock.accept = unittest.mock.Mock(side_effect=Exception)
         with self.assertRaises(Exception):
@@ -362,6 +583,29 @@ class TestAcceptDelayTrigger(unittest.TestCase):
         self.inst.wait(10)
         self.inst.conn.close.assert_called_with()
 
+    def test_wait_not_block_when_no_pending_connection(self):
+        inst = core.AcceptDelayTrigger(('127.0.0.1', 0))
+        inst.selector.close()
+        inst.selector = unittest.mock.Mock()
+        inst.selector.select = unittest.mock.Mock(return_value=[None])
+        try:
+            self.assertEqual(inst.wait(1), (None, None))
+        finally:
+            inst.sock.close()
+
+    def test_wait_return_no_cmd_when_client_idle(self):
+        inst = core.AcceptDelayTrigger(('127.0.0.1', 0))
+        client = socket.create_connection(inst.sock.getsockname())
+        try:
+            with unittest.mock.patch.object(core.AcceptDelayTrigger,
+                                            'cmd_timeout', 0.2):
+                start_time = time.time()
+                self.assertEqual(inst.wait(1), (None, None))
+                self.assertLess(time.time() - start_time, 1)
+        finally:
+            client.close()
+            inst.sock.close()
+
     @unittest.skipUnless(TEST_TIMER, 'trust socket timeout')
     def test_wait_timeout(self):
         inst = core.AcceptDelayTrigger(('127.0.0.1', 0))